@@ -1,8 +1,34 @@
+import time
 import datetime
 import requests
-import itertools
+import threading
+import collections
 
-import xml.etree.ElementTree as xml
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+from requests.adapters import Retry
+
+# Use the libxml2 backed parser when it is available, it is a lot faster than
+# the pure Python implementation in the standard library
+try:
+    from lxml import etree as xml
+
+    _HAS_LXML = True
+except ImportError:
+    import xml.etree.ElementTree as xml
+
+    _HAS_LXML = False
+
+# Use the faster orjson decoder when it is available, esearch responses can
+# contain thousands of IDs
+try:
+    import orjson
+
+    _loads = orjson.loads
+except ImportError:
+    import json
+
+    _loads = json.loads
 
 from typing import Union
 
@@ -14,13 +40,22 @@ from .book import PubMedBookArticle
 # Base url for all queries
 BASE_URL = "https://eutils.ncbi.nlm.nih.gov"
 
+# Map of XML tags to the article classes they are parsed into
+_ARTICLE_TYPES = {
+    "PubmedArticle": PubMedArticle,
+    "PubmedBookArticle": PubMedBookArticle,
+}
+
 
 class PubMed(object):
     """ Wrapper around the PubMed API.
     """
 
     def __init__(
-        self: object, tool: str = "my_tool", email: str = "my_email@example.com"
+        self: object,
+        tool: str = "my_tool",
+        email: str = "my_email@example.com",
+        api_key: str = None,
     ) -> None:
         """ Initialization of the object.
 
@@ -30,6 +65,8 @@ class PubMed(object):
                             PMC (PubMed Central).
                 - email     String, email of the user of the tool. This parameter
                             is not required but kindly requested by PMC (PubMed Central).
+                - api_key   String, NCBI API key. Optional, but raises the allowed
+                            request rate from 3 to 10 requests per second.
 
             Returns:
                 - None
@@ -39,12 +76,62 @@ class PubMed(object):
         self.tool = tool
         self.email = email
 
-        # Keep track of the rate limit
-        self._rateLimit = 3
-        self._requestsMade = []
+        # Throttle requests with a token bucket that refills at the allowed
+        # rate, so requests are spread out evenly instead of arriving in bursts
+        self._rate = 10.0 if api_key else 3.0
+        self._bucket = self._rate
+        self._lastRefill = time.monotonic()
+        self._bucketLock = threading.Lock()
 
         # Define the standard / default query parameters
         self.parameters = {"tool": tool, "email": email, "db": "pubmed"}
+        if api_key:
+            self.parameters["api_key"] = api_key
+
+        # Cache JSON responses in memory, so repeated (overlapping) queries
+        # don't cost network round trips or rate limit tokens
+        self._cache = {}
+        self._cacheSize = 128
+
+        # Use a single session for all requests, so that the underlying TCP /
+        # TLS connection is pooled and reused instead of being rebuilt per call
+        # (the pool is sized to the number of concurrent workers, so no
+        # connection is discarded under full concurrency)
+        pool_size = max(1, int(self._rate))
+        self._session = requests.Session()
+
+        # Ask for compressed responses (PubMed XML compresses very well) and
+        # identify the tool / user, as requested by the E-utilities guidelines
+        self._session.headers.update(
+            {"Accept-Encoding": "gzip, deflate", "User-Agent": f"{tool} ({email})"}
+        )
+        self._session.mount(
+            "https://",
+            HTTPAdapter(
+                pool_connections=pool_size,
+                pool_maxsize=pool_size,
+                max_retries=Retry(
+                    total=3,
+                    backoff_factor=0.3,
+                    status_forcelist=(429, 500, 502, 503, 504),
+                    # efetch requests are POSTs (and idempotent), retry them too
+                    allowed_methods=("GET", "POST"),
+                ),
+            ),
+        )
+
+    def close(self: object) -> None:
+        """ Helper method that closes the underlying session (and with it the
+            pooled connections to PubMed).
+        """
+
+        self._session.close()
+
+    def __enter__(self: object) -> object:
+        return self
+
+    def __exit__(self: object, *args: list) -> None:
+        self.close()
 
     def query(self: object, query: str, max_results: int = 100, timeout: int = 10):
         """ Method that executes a query agains the GraphQL schema, automatically
@@ -61,16 +148,8 @@ class PubMed(object):
         # Retrieve the article IDs for the query
         article_ids = self._getArticleIds(query=query, max_results=max_results, timeout=timeout, max_year=int(datetime.date.today().year))
 
-        # Get the articles themselves
-        articles = list(
-            [
-                self._getArticles(article_ids=batch, timeout=timeout)
-                for batch in batches(article_ids, 250)
-            ]
-        )
-
-        # Chain the batches back together and return the list
-        return itertools.chain.from_iterable(articles)
+        # Stream the articles to the caller
+        return self._fetchArticles(article_ids=article_ids, timeout=timeout)
 
 
     def query_publication_ids(self: object, query: str, max_results: int = 100, timeout: int = 10):
@@ -106,16 +185,8 @@ class PubMed(object):
         # # Retrieve the article IDs for the query
         # article_ids = self._getArticleIds(query=query, max_results=max_results)
 
-        # Get the articles themselves
-        articles = list(
-            [
-                self._getArticles(article_ids=batch, timeout=timeout)
-                for batch in batches(article_ids, 250)
-            ]
-        )
-
-        # Chain the batches back together and return the list
-        return itertools.chain.from_iterable(articles)
+        # Stream the articles to the caller
+        return self._fetchArticles(article_ids=article_ids, timeout=timeout)
 
     def batch_query(self: object, query: str, batch_size: int = 250, timeout:int = 10):
         # Retrieve the article IDs for the query
@@ -123,7 +194,7 @@ class PubMed(object):
 
         # Get the articles themselves
         for batch in batches(article_ids, batch_size):
-            yield list(self._getArticles(article_ids=batch, timeout=timeout))
+            yield self._getArticles(article_ids=batch, timeout=timeout)
 
     def getTotalResultsCount(self: object, query: str, timeout: int = 10) -> int:
         """ Helper method that returns the total number of results that match the query.
@@ -135,74 +206,136 @@ class PubMed(object):
                 - total_results_count   Int, total number of results for the query in PubMed
         """
 
-        # Get the default parameters
-        parameters = self.parameters.copy()
-
-        # Add specific query parameters
-        parameters["term"] = query
-        parameters["retmax"] = 1
-
         # Make the request (request a single article ID for this search)
-        response = self._get(url="/entrez/eutils/esearch.fcgi", parameters=parameters, timeout=timeout)
+        response = self._get(url="/entrez/eutils/esearch.fcgi", extra={"term": query, "retmax": 1}, timeout=timeout)
 
         # Get from the returned meta data the total number of available results for the query
         total_results_count = int(response.get("esearchresult", {}).get("count"))
 
         # Return the total number of results (without retrieving them)
         return total_results_count
-    
-    def _exceededRateLimit(self) -> bool:
-        """ Helper method to check if we've exceeded the rate limit.
+
+    def _fetchArticles(self: object, article_ids: list, timeout: int = 10):
+        """ Helper method that fetches batches of articles concurrently and
+            yields them one by one, keeping only a bounded number of batches
+            in memory at any point in time.
+
+            Parameters:
+                - article_ids   List, article IDs.
 
             Returns:
-                - exceeded      Bool, Whether or not the rate limit is exceeded.
+                - articles      Generator, article objects.
         """
 
-        # Remove requests from the list that are longer than 1 second ago
-        self._requestsMade = [requestTime for requestTime in self._requestsMade if requestTime > datetime.datetime.now() - datetime.timedelta(seconds=1)]
+        max_workers = max(1, int(self._rate))
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+
+            # Keep at most one batch per worker in flight, yielding the oldest
+            # batch as soon as it completes
+            pending = collections.deque()
+            for batch in batches(article_ids, 250):
+                pending.append(executor.submit(self._getArticles, batch, timeout))
+                if len(pending) > max_workers:
+                    yield from pending.popleft().result()
 
-        # Return whether we've made more requests in the last second, than the rate limit
-        return len(self._requestsMade) > self._rateLimit
+            # Drain the remaining batches
+            while pending:
+                yield from pending.popleft().result()
 
     def _get(
-        self: object, url: str, parameters: dict, output: str = "json", timeout: int = 10
-    ) -> Union[dict, str]:
+        self: object,
+        url: str,
+        extra: dict = None,
+        output: str = "json",
+        timeout: int = 10,
+        method: str = "GET",
+    ) -> Union[dict, object]:
         """ Generic helper method that makes a request to PubMed.
 
             Parameters:
                 - url           Str, last part of the URL that is requested (will
                                 be combined with the base url)
-                - parameters    Dict, parameters to use for the request
+                - extra         Dict, request specific parameters, merged on top
+                                of the default query parameters
                 - output        Str, type of output that is requested (defaults to
                                 JSON but can be used to retrieve XML)
+                - method        Str, HTTP method to use (POST puts the parameters
+                                in the request body, which avoids URL length
+                                limits for large ID lists)
 
             Returns:
-                - response      Dict / str, if the response is valid JSON it will
-                                be parsed before returning, otherwise a string is
-                                returend
+                - response      Dict / file, if the response is valid JSON it will
+                                be parsed before returning, otherwise the raw
+                                response stream is returned
         """
 
-        # Make sure the rate limit is not exceeded
-        while self._exceededRateLimit():
-            pass
+        # Merge the defaults with the request specific parameters (this never
+        # mutates self.parameters, so no state can leak between requests)
+        parameters = {**self.parameters, **(extra or {}), "retmode": output}
 
-        # Set the response mode
-        parameters["retmode"] = output
-
-        # Make the request to PubMed
-        response = requests.get(f"{BASE_URL}{url}", params=parameters, timeout=timeout)
+        # Serve repeated JSON requests from the cache, skipping the network
+        # (and the rate limiter) entirely
+        if output == "json":
+            cache_key = (
+                url,
+                tuple(
+                    sorted(
+                        (key, tuple(value) if isinstance(value, list) else value)
+                        for key, value in parameters.items()
+                    )
+                ),
+            )
+            if cache_key in self._cache:
+                return self._cache[cache_key]
+
+        # Take a token from the bucket, sleeping exactly until one has been
+        # refilled when the bucket is empty (the lock serializes the admission
+        # decision between worker threads, the requests themselves run
+        # concurrently)
+        with self._bucketLock:
+            now = time.monotonic()
+            self._bucket = min(self._rate, self._bucket + (now - self._lastRefill) * self._rate)
+            self._lastRefill = now
+            if self._bucket < 1.0:
+                time.sleep((1.0 - self._bucket) / self._rate)
+
+                # The slept interval refilled the token spent here, move the
+                # refill marker past it so the next caller doesn't count the
+                # same interval again
+                self._lastRefill = time.monotonic()
+                self._bucket = 0.0
+            else:
+                self._bucket -= 1.0
+
+        # Make the request to PubMed (streaming for XML, so that the caller
+        # can parse the response incrementally)
+        if method == "POST":
+            response = self._session.post(
+                f"{BASE_URL}{url}", data=parameters, stream=(output == "xml"), timeout=timeout
+            )
+        else:
+            response = self._session.get(
+                f"{BASE_URL}{url}", params=parameters, stream=(output == "xml"), timeout=timeout
+            )
 
         # Check for any errors
         response.raise_for_status()
 
-        # Add this request to the list of requests made
-        self._requestsMade.append(datetime.datetime.now())
-
-        # Return the response
+        # Return the response (as a raw byte stream for XML, so that it can be
+        # parsed incrementally instead of being loaded into memory at once)
         if output == "json":
-            return response.json()
+            result = _loads(response.content)
+
+            # Store the result in the cache, dropping the oldest entry when
+            # the cache is full
+            if len(self._cache) >= self._cacheSize:
+                self._cache.pop(next(iter(self._cache)))
+            self._cache[cache_key] = result
+
+            return result
         else:
-            return response.text
+            response.raw.decode_content = True
+            return response.raw
 
     def _getArticles(self: object, article_ids: list, timeout: int = 10) -> list:
         """ Helper method that batches a list of article IDs and retrieves the content.
@@ -214,23 +347,44 @@ class PubMed(object):
                 - articles      List, article objects.
         """
 
-        # Get the default parameters
-        parameters = self.parameters.copy()
-        parameters["id"] = article_ids
-
-        # Make the request
+        # Make the request (as a POST, the ID list is too large for a query
+        # string; NCBI expects a single comma separated id parameter)
         response = self._get(
-            url="/entrez/eutils/efetch.fcgi", parameters=parameters, output="xml", timeout=timeout
+            url="/entrez/eutils/efetch.fcgi",
+            extra={"id": ",".join(map(str, article_ids))},
+            output="xml",
+            timeout=timeout,
+            method="POST",
         )
 
-        # Parse as XML
-        root = xml.fromstring(response)
-
-        # Loop over the articles and construct article objects
-        for article in root.iter("PubmedArticle"):
-            yield PubMedArticle(xml_element=article)
-        for book in root.iter("PubmedBookArticle"):
-            yield PubMedBookArticle(xml_element=book)
+        # Parse the XML incrementally, so that only a single article has to be
+        # kept in memory at any point in time
+        if _HAS_LXML:
+            elements = xml.iterparse(
+                response, events=("end",), tag=tuple(_ARTICLE_TYPES)
+            )
+        else:
+            elements = xml.iterparse(response, events=("end",))
+
+        # Loop over the articles and construct article objects (materialized
+        # into a list, so that a batch can be fetched on a worker thread)
+        articles = []
+        for event, element in elements:
+            article_type = _ARTICLE_TYPES.get(element.tag)
+            if article_type is None:
+                continue
+            articles.append(article_type(xml_element=element))
+
+            # Detach already processed articles from the tree, so they can be
+            # garbage collected as soon as the consumer drops them. The
+            # elements themselves are kept intact, they are exposed to the
+            # user through the xml attribute. (Without lxml there is no handle
+            # on the parent, so the tree is only released as a whole.)
+            if _HAS_LXML:
+                while element.getprevious() is not None:
+                    del element.getparent()[0]
+
+        return articles
 
     def _getArticleIds(self: object, query: str, max_results: int, timeout: int = 10, min_year: int = 1500,
                        max_year: int = 3000, min_month:int =1, max_month: int= 12, min_day: int=1, max_day:int=31) -> list:
@@ -246,117 +400,82 @@ class PubMed(object):
 
         ## Novel strateies necessary to keep Query below 10k entries:
         # Idea: Split dataset in batches int(all_results/10.000) + 1; SPlit Year Range into an equal amaount of Time Frames
-        # Call FUnction again with set Year Range
+        # Process the date windows with a work queue instead of recursing per subrange
 
         # Create a placeholder for the retrieved IDs
         article_ids = []
-
-        # Get the default parameters
-        parameters = self.parameters.copy()
         max_entries = 10000
-        # Add specific query parameters
-        parameters["term"] = f"\"{query}\""
-        parameters["retmax"] = 0
-        parameters["mindate"] =f"{min_year}/{min_month}/{min_day}"
-        parameters["maxdate"] =f"{max_year}/{max_month}/{max_day}"
-
-        # # Calculate a cut off point based on the max_results parameter
-        # if max_results < parameters["retmax"]:
-        #     parameters["retmax"] = max_results
-
-        # Make the first request to PubMed
-        response = self._get(url="/entrez/eutils/esearch.fcgi", parameters=parameters, timeout=timeout)
-        # get amount of total fitting publications
-        total_result_count = int(response.get("esearchresult", {}).get("count"))
-
-        # <editor-fold desc="Description">
-        if total_result_count > max_entries:
-            batch_count = int(total_result_count//max_entries) + 1
-            if min_year != max_year:
-
-                year_gap = max_year - min_year
-                year_step = year_gap // batch_count
-                year_boundaries = {min_year + (year_step * i) for i in range(batch_count)}
-                for i in sorted(year_boundaries):
-                    article_ids += self._getArticleIds(query=query, max_results=max_results, timeout=timeout,
-                                                  min_year=i if i==min_year else i +1, max_year=i + year_step)
-                if isinstance(year_gap/batch_count, float) and i + year_step != max_year:
-                    article_ids += self._getArticleIds(query=query, max_results=max_results, timeout=timeout,
-                                                       min_year=i + year_step, max_year=max_year)
-
-                return article_ids
-            else:
-                if min_month != min_month:
-                    month_gap = max_month - min_month
-                    month_step = month_gap // batch_count
-                    month_boundaries = {min_month + (month_step * i) for i in range(batch_count)}
-                    for i in sorted(month_boundaries):
-                        article_ids += self._getArticleIds(query=query, max_results=max_results, timeout=timeout,
-                                                      min_year=min_year, max_year=max_year,
-                                                      min_month=i if i==min_month else i +1, max_month=i + month_step)
-                    if isinstance(month_gap / batch_count, float) and i + month_step != max_month:
-                        article_ids += self._getArticleIds(query=query, max_results=max_results, timeout=timeout,
-                                                           min_year=min_year, max_year=max_year,
-                                                           min_month=i + month_step, max_month=max_month)
-                    return article_ids
+
+        # Process the date windows front to back, splitting windows with too
+        # many results into smaller ones
+        frames = collections.deque([(min_year, max_year, min_month, max_month, min_day, max_day)])
+        while frames:
+            min_year, max_year, min_month, max_month, min_day, max_day = frames.popleft()
+
+            # Add specific query parameters (usehistory makes the server keep the
+            # result set, so follow-up calls don't re-execute the query)
+            extra = {
+                "term": f"\"{query}\"",
+                "retmax": 0,
+                "usehistory": "y",
+                "mindate": f"{min_year}/{min_month}/{min_day}",
+                "maxdate": f"{max_year}/{max_month}/{max_day}",
+            }
+
+            # Make the first request to PubMed
+            response = self._get(url="/entrez/eutils/esearch.fcgi", extra=extra, timeout=timeout)
+            # get amount of total fitting publications
+            total_result_count = int(response.get("esearchresult", {}).get("count"))
+
+            # Too many results for this window, split it into smaller windows
+            # and queue those instead (prepended, so the IDs stay in date order)
+            if total_result_count > max_entries:
+                # The number of splits is clamped to the window span, so every
+                # child covers at least one unit and is strictly smaller than
+                # its parent (otherwise a window could requeue itself forever)
+                batch_count = int(total_result_count // max_entries) + 1
+                children = []
+                if min_year != max_year:
+                    span = max_year - min_year + 1
+                    split_count = min(batch_count, span)
+                    for i in range(split_count):
+                        children.append((min_year + (span * i) // split_count,
+                                         min_year + (span * (i + 1)) // split_count - 1,
+                                         1, 12, 1, 31))
+                elif min_month != max_month:
+                    span = max_month - min_month + 1
+                    split_count = min(batch_count, span)
+                    for i in range(split_count):
+                        children.append((min_year, max_year,
+                                         min_month + (span * i) // split_count,
+                                         min_month + (span * (i + 1)) // split_count - 1,
+                                         1, 31))
+                elif min_day != max_day:
+                    span = max_day - min_day + 1
+                    split_count = min(batch_count, span)
+                    for i in range(split_count):
+                        children.append((min_year, max_year, min_month, max_month,
+                                         min_day + (span * i) // split_count,
+                                         min_day + (span * (i + 1)) // split_count - 1))
                 else:
-                    if min_day != min_day:
-                        day_gap = max_day - min_day
-                        day_step = day_gap// batch_count
-                        day_boundaries = {min_day + (day_step * i) for i in range(batch_count)}
-                        for i in sorted(day_boundaries):
-                            article_ids += self._getArticleIds(query=query, max_results=max_results, timeout=timeout,
-                                                          min_year=min_year, max_year=max_year,
-                                                          min_month=min_month, max_month=max_month,
-                                                          min_day=i if i==min_day else i +1, max_day=i + day_step)
-                        if isinstance(day_gap / batch_count, float) and i + day_step != max_day:
-                            article_ids += self._getArticleIds(query=query, max_results=max_results,
-                                                               timeout=timeout,
-                                                               min_year=min_year, max_year=max_year,
-                                                               min_month=min_month, max_month=max_month,
-                                                               min_day=i+day_step, max_day=max_day)
-                        return article_ids
-                    else:
-                        print("Year range:", min_year, max_year, "Month range:", min_month, max_month, "Day range:",
-                              min_day, max_day, "Too many entries:", total_result_count)
-                        return article_ids # if more than 10.000 entries are given per day, they can not be retrieved!
-            # YYYY / MM / DD, and these variants are also allowed: YYYY, YYYY / MM.
-        # </editor-fold>
-
-        # Add the retrieved IDs to the list
-        parameters["retmax"] = max_entries
-        response = self._get(url="/entrez/eutils/esearch.fcgi", parameters=parameters, timeout=timeout)
-
-        article_ids += response.get("esearchresult", {}).get("idlist", [])
-        return article_ids
+                    # if more than 10.000 entries are given per day, they can not be retrieved!
+                    print("Year range:", min_year, max_year, "Month range:", min_month, max_month, "Day range:",
+                          min_day, max_day, "Too many entries:", total_result_count)
+
+                frames.extendleft(reversed(children))
+                continue
+
+            # Retrieve the IDs by referencing the stored result set on the
+            # history server ("#<query_key>" + WebEnv), instead of sending the
+            # boolean query again (esearch caps retstart + retmax at 10.000,
+            # so larger result sets are split by date range above)
+            extra = {
+                "term": f"#{response.get('esearchresult', {}).get('querykey')}",
+                "WebEnv": response.get("esearchresult", {}).get("webenv"),
+                "retmax": max_entries,
+            }
+            response = self._get(url="/entrez/eutils/esearch.fcgi", extra=extra, timeout=timeout)
+
+            article_ids.extend(response.get("esearchresult", {}).get("idlist", []))
 
-        # # Get information from the response
-        # retrieved_count = int(response.get("esearchresult", {}).get("retmax")) -1
-        #
-        # # If no max is provided (-1) we'll try to retrieve everything
-        # if max_results == -1:
-        #     max_results = total_result_count
-        #
-        # # If not all articles are retrieved, continue to make requests untill we have everything
-        # while retrieved_count < total_result_count and retrieved_count < max_results:
-        #
-        #     # Calculate a cut off point based on the max_results parameter
-        #     if (max_results - retrieved_count) < parameters["retmax"]:
-        #         parameters["retmax"] = max_results - retrieved_count
-        #
-        #     # Start the collection from the number of already retrieved articles
-        #     parameters["retstart"] = retrieved_count
-        #
-        #     # Make a new request
-        #     response = self._get(
-        #         url="/entrez/eutils/esearch.fcgi", parameters=parameters
-        #     )
-        #
-        #     # Add the retrieved IDs to the list
-        #     article_ids += response.get("esearchresult", {}).get("idlist", [])
-        #
-        #     # Get information from the response
-        #     retrieved_count += int(response.get("esearchresult", {}).get("retmax"))
-        #
-        # # Return the response
-        # return article_ids
+        return article_ids
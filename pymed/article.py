@@ -5,6 +5,13 @@ from xml.etree.ElementTree import Element
 from typing import TypeVar
 from typing import Optional
 
+# lxml elements are a different class than the standard library ones, cover
+# both when serializing to JSON
+try:
+    from lxml.etree import _Element
+except ImportError:
+    _Element = Element
+
 from .helpers import getContent
 
 
@@ -152,7 +159,7 @@ class PubMedArticle(object):
 
         return json.dumps(
             {
-                key: (value if not isinstance(value, (datetime.date, Element)) else str(value))
+                key: (value if not isinstance(value, (datetime.date, Element, _Element)) else str(value))
                 for key, value in self.toDict().items()
             },
             sort_keys=True,